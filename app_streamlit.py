@@ -5,6 +5,10 @@ Optimized for performance, user experience, and error handling.
 Supports Persian and English with a modern chat interface.
 """
 
+import html
+import time
+from collections import deque
+from itertools import islice
 import streamlit as st
 import logging
 from src.chatbot import Chatbot
@@ -23,15 +27,14 @@ st.set_page_config(
 )
 
 # --- CSS STYLE ---
-st.markdown("""
+_CSS = """
     <style>
         body {
             background-color: #0a0a0f;
         }
         .chat-container {
-            max-height: 70vh;
-            overflow-y: auto;
-            padding: 10px;
+            display: flex;
+            flex-direction: column;
         }
         .chat-bubble-user {
             background-color: #1f1f2e;
@@ -70,7 +73,17 @@ st.markdown("""
             50% {opacity: 0;}
         }
     </style>
-""", unsafe_allow_html=True)
+"""
+
+def _inject_css():
+    """Emit the minified stylesheet, bypassing the markdown pipeline when `st.html` is available."""
+    css = " ".join(_CSS.split())
+    if hasattr(st, "html"):
+        st.html(css)
+    else:
+        st.markdown(css, unsafe_allow_html=True)
+
+_inject_css()
 
 # --- HEADER ---
 st.markdown("<h1 style='text-align:center; color:#00ffff;'>Welcome to the AI-1900 Chatbot</h1>", unsafe_allow_html=True)
@@ -78,17 +91,30 @@ st.markdown("<p style='text-align:center; color:#888;'>Bilingual Persian-English
 st.markdown("<hr style='border:1px solid #00ffff;'>", unsafe_allow_html=True)
 
 # --- INITIALIZATION ---
+@st.cache_resource(show_spinner="Loading models...")
+def get_chatbot():
+    """Load models once per process and warm up generation before serving users."""
+    chatbot = Chatbot()
+    chatbot.initialize_models()
+    # Trigger compilation / quantization on the paths the app serves: greedy
+    # streaming for English, beam search plus translation for Persian
+    for _ in chatbot.stream_response("hello"):
+        pass
+    chatbot.generate_response("سلام")
+    chatbot.clear_cache()
+    logger.info("Chatbot models loaded and warmed up.")
+    return chatbot
+
 def initialize_chatbot():
     """Initialize chatbot with error handling."""
     try:
         if "chatbot" not in st.session_state:
-            st.session_state.chatbot = Chatbot()
+            st.session_state.chatbot = get_chatbot()
             logger.info("Chatbot initialized successfully.")
         if "history" not in st.session_state:
-            st.session_state.history = []
+            # Bounded history: the deque drops the oldest messages to prevent memory issues
+            st.session_state.history = deque(maxlen=50)
             logger.info("Chat history initialized.")
-        if "history_limit" not in st.session_state:
-            st.session_state.history_limit = 50  # Limit history to prevent memory issues
     except Exception as e:
         logger.error(f"Failed to initialize chatbot: {str(e)}")
         st.error("Failed to initialize chatbot. Please try again.")
@@ -97,17 +123,51 @@ def initialize_chatbot():
 initialize_chatbot()
 
 # --- CHAT HISTORY DISPLAY ---
+def render_bubble(sender, message):
+    """Build the HTML for a single chat bubble (computed once per message)."""
+    css_class = "chat-bubble-user" if sender == "user" else "chat-bubble-bot"
+    # Newlines become <br> so a blank line cannot end the raw-HTML block early
+    body = html.escape(message).replace("\n", "<br>")
+    return f"<div class='{css_class}'>{body}</div>"
+
+def append_message(sender, message, message_en=None):
+    """Add a message to history with its pre-rendered bubble HTML and English text (if known)."""
+    st.session_state.history.append((sender, message, render_bubble(sender, message), message_en))
+
+def render_container(bubbles):
+    """Wrap bubble HTML in the flex container that aligns user and bot bubbles."""
+    return f'<div class="chat-container">{bubbles}</div>'
+
 def display_chat_history():
-    """Display chat history efficiently."""
-    with st.container():
-        chat_container = st.container()
-        chat_container.markdown('<div class="chat-container">', unsafe_allow_html=True)
-        for sender, message in st.session_state.history:
-            if sender == "user":
-                chat_container.markdown(f"<div class='chat-bubble-user'>{message}</div>", unsafe_allow_html=True)
-            else:
-                chat_container.markdown(f"<div class='chat-bubble-bot'>{message}</div>", unsafe_allow_html=True)
-        chat_container.markdown('</div>', unsafe_allow_html=True)
+    """Display chat history with a single markdown call over cached bubble HTML."""
+    bubbles = "".join(rendered for _, _, rendered, _ in st.session_state.history)
+    st.markdown(render_container(bubbles), unsafe_allow_html=True)
+
+def stream_bot_response(placeholder, chunks, min_interval=0.05, min_chars=8):
+    """
+    Render streamed response chunks into `placeholder`, throttling UI updates.
+
+    The bubble is only redrawn once `min_interval` seconds have passed or
+    `min_chars` new characters have arrived since the last redraw.
+    """
+    buffer = ""
+    pending_chars = 0
+    last_flush = time.monotonic()
+    for chunk in chunks:
+        buffer += chunk
+        pending_chars += len(chunk)
+        now = time.monotonic()
+        if pending_chars >= min_chars or now - last_flush >= min_interval:
+            placeholder.markdown(render_container(render_bubble("bot", buffer)), unsafe_allow_html=True)
+            pending_chars = 0
+            last_flush = now
+    response = buffer.strip()
+    placeholder.markdown(render_container(render_bubble("bot", response)), unsafe_allow_html=True)
+    return response
+
+# Render history once per run; new messages are drawn incrementally below it
+if st.session_state.history:
+    display_chat_history()
 
 # --- USER INPUT ---
 user_input = st.chat_input("Type your message (in Persian or English)...", key="user_input")
@@ -115,42 +175,39 @@ user_input = st.chat_input("Type your message (in Persian or English)...", key="
 if user_input:
     try:
         # Add user message to history
-        st.session_state.history.append(("user", user_input))
+        append_message("user", user_input)
         logger.debug(f"User input: {user_input}")
 
-        # Limit history size
-        if len(st.session_state.history) > st.session_state.history_limit:
-            st.session_state.history = st.session_state.history[-st.session_state.history_limit:]
-            logger.info("Chat history trimmed to maintain limit.")
-
-        # Display updated history
-        display_chat_history()
+        # Show the new user message without re-rendering history
+        st.markdown(render_container(render_bubble("user", user_input)), unsafe_allow_html=True)
 
         # Detect language
         lang = detect_language(user_input)
         logger.debug(f"Detected language: {lang}")
 
-        # Show typing animation using a spinner
-        with st.spinner("🤖 Generating response..."):
-            # Generate bot response
-            bot_response = st.session_state.chatbot.generate_response(
-                user_input,
-                max_length=128,
-                num_beams=4
+        # Sliding window of previous turns (excluding the message just added) as context
+        history = st.session_state.history
+        window = st.session_state.chatbot.window * 2
+        previous = islice(history, max(len(history) - window - 1, 0), len(history) - 1)
+        context = [(sender, message, message_en) for sender, message, _, message_en in previous]
+
+        # Show typing indicator until the first chunk arrives, then stream the reply
+        placeholder = st.empty()
+        placeholder.markdown("<div class='typing'>🤖 Generating response...</div>", unsafe_allow_html=True)
+        english = {}
+        bot_response = stream_bot_response(
+            placeholder,
+            st.session_state.chatbot.stream_response(
+                user_input, max_length=128, history=context, english_out=english
             )
+        )
 
-        # Add bot response to history
-        st.session_state.history.append(("bot", bot_response))
+        # Keep the English text of both turns so later context needs no re-translation
+        sender, message, rendered, _ = history[-1]
+        history[-1] = (sender, message, rendered, english.get("user"))
+        append_message("bot", bot_response, english.get("bot"))
         logger.debug(f"Bot response: {bot_response}")
 
-        # Update display with new response
-        display_chat_history()
-
-        # Clear translation cache periodically to manage memory
-        if len(st.session_state.history) % 10 == 0:
-            st.session_state.chatbot.clear_cache()
-            logger.info("Translation cache cleared to optimize memory.")
-
     except ValueError as ve:
         logger.error(f"Invalid input error: {str(ve)}")
         st.error("Invalid input. Please enter a valid message.")
@@ -160,7 +217,3 @@ if user_input:
     except Exception as e:
         logger.error(f"Unexpected error: {str(e)}")
         st.error("An unexpected error occurred. Please try again.")
-
-# Initial display of chat history
-if st.session_state.history:
-    display_chat_history()
@@ -3,24 +3,169 @@
 Chatbot Core Logic
 ------------------
 Implements a bilingual chatbot with support for Persian and English.
-Uses BlenderBot for conversation and MT5-based models for translation.
-Optimized for performance with lazy loading, caching, and error handling.
+Uses BlenderBot for conversation and a multilingual NLLB model for translation.
+Optimized for performance with eager model loading, request batching, caching, and error handling.
 """
 
+import threading
 import torch
 import logging
-from functools import lru_cache
+from collections import OrderedDict
+from transformers import TextIteratorStreamer
+from transformers.generation.streamers import BaseStreamer
 from src.model_loader import load_blenderbot_model, load_translation_models
-from src.utils import detect_language, translate_text
+from src.utils import InputBuffer, MicroBatcher, TranslationBatcher, detect_language, uses_static_cache
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def _normalize(text):
+    """Normalize text for use as a translation cache key."""
+    return " ".join(text.strip().lower().split())
+
+class _BatchStreamer(BaseStreamer):
+    """
+    Fan a batched greedy `generate` out to per-request streamers.
+
+    `generate` accepts a single streamer and pushes one token per batch row at
+    every step; each row is forwarded to its request's streamer (rows without
+    one are skipped).
+    """
+
+    def __init__(self, streamers):
+        self.streamers = streamers
+        self._prompt_skipped = False
+        self._ended = False
+
+    def put(self, value):
+        # The first call carries the decoder prompt, which is not part of the reply
+        if not self._prompt_skipped:
+            self._prompt_skipped = True
+            return
+        for row, streamer in enumerate(self.streamers):
+            if streamer is not None:
+                streamer.put(value[row:row + 1])
+
+    def end(self):
+        if self._ended:
+            return
+        self._ended = True
+        for streamer in self.streamers:
+            if streamer is not None:
+                streamer.end()
+
+class RequestQueue(MicroBatcher):
+    """
+    Batch concurrent BlenderBot prompts into shared `generate` calls.
+
+    Prompts from different sessions that arrive within `max_wait` seconds are
+    padded together and decoded in one batch ("continuous batching" lite).
+    Requests with different generation settings are decoded separately.
+    The worker is the only thread that calls `generate` on the model, so
+    streaming and non-streaming requests never run on it concurrently.
+    """
+
+    def __init__(self, tokenizer, model, device, max_batch_size=8, max_wait=0.015):
+        """
+        Args:
+            tokenizer: BlenderBot tokenizer.
+            model: BlenderBot model.
+            device (str): Device the model runs on ('cuda' or 'cpu').
+            max_batch_size (int): Maximum number of prompts per `generate` call.
+            max_wait (float): Seconds to wait for more prompts before flushing.
+        """
+        self.tokenizer = tokenizer
+        self.model = model
+        self.device = device
+        # Only the worker thread touches this buffer
+        self._input_buffer = InputBuffer(max_batch_size, 128, device)
+        super().__init__("bot-request-queue", max_batch_size, max_wait)
+
+    def generate(self, prompt_ids, max_length=128, num_beams=4):
+        """Generate a reply to the tokenized prompt, blocking until its batch has been decoded."""
+        return self.submit((prompt_ids, max_length, num_beams, None)).result()
+
+    def stream(self, prompt_ids, streamer, max_length=128):
+        """
+        Queue a greedy request whose tokens are pushed to `streamer` as they are decoded.
+
+        Streaming is not supported with beam search. Returns a future that
+        resolves to the full reply (or raises if generation failed).
+        """
+        return self.submit((prompt_ids, max_length, 1, streamer))
+
+    @torch.inference_mode()
+    def _process_batch(self, requests):
+        results = [None] * len(requests)
+        groups = {}
+        for index, (_, max_length, num_beams, _) in enumerate(requests):
+            groups.setdefault((max_length, num_beams), []).append(index)
+
+        group_streamers = {}
+        for key, indices in groups.items():
+            streamers = [requests[index][3] for index in indices]
+            group_streamers[key] = _BatchStreamer(streamers) if any(streamers) else None
+
+        try:
+            for key, indices in groups.items():
+                try:
+                    replies = self._generate_group(
+                        [requests[index][0] for index in indices], *key, group_streamers[key]
+                    )
+                except Exception as e:
+                    # A failing group only fails its own requests
+                    logger.error(f"Batched generation failed: {str(e)}")
+                    replies = [e] * len(indices)
+                for index, reply in zip(indices, replies):
+                    results[index] = reply
+        finally:
+            # Unblock every stream consumer, including groups that never ran
+            for batch_streamer in group_streamers.values():
+                if batch_streamer is not None:
+                    batch_streamer.end()
+        return results
+
+    def _generate_group(self, id_lists, max_length, num_beams, batch_streamer):
+        """Decode prompts that share generation settings in one `generate` call."""
+        # A compiled decode step needs fixed shapes; otherwise pad only to the longest prompt
+        static_shapes = uses_static_cache(self.model)
+        count = len(id_lists)
+        if static_shapes:
+            # Fill the batch with copies of the first prompt so every call has
+            # the same batch size and reuses one static cache and compiled graph
+            id_lists = id_lists + [id_lists[0]] * (self.max_batch_size - count)
+        # The attention mask keeps padded positions out of beam search
+        inputs = self._input_buffer.pad(
+            id_lists,
+            self.tokenizer.pad_token_id,
+            max_length if static_shapes else None
+        )
+        # Beam-only settings are passed only when beam search is actually used
+        beam_kwargs = {"early_stopping": True} if num_beams > 1 else {}
+        # `generate` sizes the static cache from `max_length`, matching the padded prompts
+        cache_kwargs = {"cache_implementation": "static"} if static_shapes else {}
+        try:
+            reply_ids = self.model.generate(
+                **inputs,
+                max_length=max_length,
+                num_beams=num_beams,
+                use_cache=True,          # Reuse past key/values across decode steps
+                no_repeat_ngram_size=2,  # Prevent repetitive phrases
+                streamer=batch_streamer,
+                **cache_kwargs,
+                **beam_kwargs
+            )
+        finally:
+            # Let this group's stream consumers finish without waiting for later groups
+            if batch_streamer is not None:
+                batch_streamer.end()
+        return self.tokenizer.batch_decode(reply_ids[:count], skip_special_tokens=True)
+
 class Chatbot:
     def __init__(self, device="cuda" if torch.cuda.is_available() else "cpu"):
         """
-        Initialize the bilingual chatbot with lazy-loaded models.
+        Initialize the bilingual chatbot. Models are loaded by `initialize_models`.
 
         Args:
             device (str): Device to run models on ('cuda' or 'cpu').
@@ -29,28 +174,123 @@ class Chatbot:
         self.bb_tokenizer = None
         self.bb_model = None
         self.translation_models = None
+        self._translator = None
+        self._request_queue = None
         self._is_initialized = False
+        self._init_lock = threading.Lock()
+        # Sessions share one Chatbot, so the translation cache is guarded by a lock
+        self._trans_cache_lock = threading.Lock()
+        self._trans_cache = OrderedDict()
+        self._trans_cache_max = 256
+        # Token ids of recurring history turns, keyed by turn text
+        self._turn_ids_lock = threading.Lock()
+        self._turn_ids = OrderedDict()
+        self._turn_ids_max = 1024
+        # Number of past exchanges (user + bot turns) fed to BlenderBot as context
+        self.window = 6
         logger.info(f"Chatbot initialized with device: {self.device}")
 
     def initialize_models(self):
-        """Lazily load models only when needed."""
+        """Load models once; subsequent calls are no-ops."""
+        with self._init_lock:
+            self._initialize_models()
+
+    def _initialize_models(self):
         if not self._is_initialized:
             try:
                 self.bb_tokenizer, self.bb_model = load_blenderbot_model(device=self.device)
+                self._request_queue = RequestQueue(self.bb_tokenizer, self.bb_model, self.device)
                 self.translation_models = load_translation_models(device=self.device)
+                # A single worker owns the NLLB model and batches both directions
+                self._translator = TranslationBatcher(self.translation_models, device=self.device)
                 self._is_initialized = True
                 logger.info("Models loaded successfully.")
             except Exception as e:
                 logger.error(f"Failed to load models: {str(e)}")
                 raise RuntimeError(f"Model loading failed: {str(e)}")
 
-    @lru_cache(maxsize=100)
     def _cached_translate(self, text, direction):
         """Cache translation results to avoid redundant computations."""
-        return translate_text(text, direction, self.translation_models)
+        return self._translate_many([text], direction)[0]
+
+    def _translate_many(self, texts, direction):
+        """Translate several texts, submitting all cache misses together so they share one batch."""
+        results = [None] * len(texts)
+        with self._trans_cache_lock:
+            for index, text in enumerate(texts):
+                key = (direction, _normalize(text))
+                if key in self._trans_cache:
+                    self._trans_cache.move_to_end(key)
+                    results[index] = self._trans_cache[key]
+
+        futures = {
+            index: self._translator.submit((text, direction))
+            for index, text in enumerate(texts)
+            if results[index] is None
+        }
+        for index, future in futures.items():
+            results[index] = future.result()
+            self._cache_translation((direction, _normalize(texts[index])), results[index])
+        return results
+
+    def _cache_translation(self, key, translated):
+        """Insert a translation into the LRU cache, evicting the oldest entry if full."""
+        with self._trans_cache_lock:
+            self._trans_cache[key] = translated
+            self._trans_cache.move_to_end(key)
+            if len(self._trans_cache) > self._trans_cache_max:
+                self._trans_cache.popitem(last=False)
+
+    def _tokenize_turn(self, text):
+        """Token ids for one turn, without special tokens."""
+        return tuple(self.bb_tokenizer.encode(text, add_special_tokens=False))
+
+    def _encode_turn(self, text):
+        """Token ids for a history turn, cached in a bounded LRU since turns recur across requests."""
+        with self._turn_ids_lock:
+            ids = self._turn_ids.get(text)
+            if ids is not None:
+                self._turn_ids.move_to_end(text)
+                return ids
+        ids = self._tokenize_turn(text)
+        with self._turn_ids_lock:
+            self._turn_ids[text] = ids
+            if len(self._turn_ids) > self._turn_ids_max:
+                self._turn_ids.popitem(last=False)
+        return ids
+
+    def _build_bot_input_ids(self, input_for_bot, history=None, max_length=128):
+        """
+        Token ids for the last `window` exchanges followed by the current turn.
+
+        Turns are newline-separated, the format BlenderBot was trained on.
+        BlenderBot's tokenizer never merges tokens across a newline, so each
+        history turn is tokenized once and cached; only the new input is
+        tokenized per request. Turns carrying their English text (see
+        `english_out`) are used as-is; remaining Persian turns are translated
+        together in one batch.
+        """
+        turns = list(history or [])[-self.window * 2:]
+        texts = [turn[2] if len(turn) > 2 and turn[2] else turn[1] for turn in turns]
+        persian = [
+            index for index, turn in enumerate(turns)
+            if not (len(turn) > 2 and turn[2]) and detect_language(turn[1]) == "fa"
+        ]
+        if persian:
+            translated = self._translate_many([texts[index] for index in persian], "fa_en")
+            for index, text in zip(persian, translated):
+                texts[index] = text
+
+        ids = []
+        for text in texts:
+            ids.extend(self._encode_turn(text + "\n"))
+        ids.extend(self._tokenize_turn(input_for_bot))
+
+        # Keep the most recent tokens when the context window overflows
+        budget = max_length - self.bb_tokenizer.num_special_tokens_to_add()
+        return self.bb_tokenizer.build_inputs_with_special_tokens(ids[-budget:])
 
-    @torch.no_grad()
-    def generate_response(self, user_input, max_length=128, num_beams=4):
+    def generate_response(self, user_input, max_length=128, num_beams=4, history=None, english_out=None):
         """
         Generate a bilingual response based on user input.
 
@@ -58,6 +298,11 @@ class Chatbot:
             user_input (str): Input text from the user (Persian or English).
             max_length (int): Maximum length of the generated response.
             num_beams (int): Number of beams for beam search in BlenderBot.
+            history (list): Previous (sender, message) or (sender, message, message_en)
+                turns, oldest first. Only the last `window` exchanges are used as context;
+                `message_en` avoids re-translating Persian turns.
+            english_out (dict): If given, filled with the English text of this turn
+                under 'user' and 'bot', for reuse as `message_en` in later history.
 
         Returns:
             str: Response in the user's input language.
@@ -70,9 +315,9 @@ class Chatbot:
             logger.error("Invalid or empty input provided.")
             raise ValueError("Input must be a non-empty string.")
 
-        # Ensure models are loaded
         if not self._is_initialized:
-            self.initialize_models()
+            logger.error("generate called before models were loaded.")
+            raise RuntimeError("Models are not loaded. Call initialize_models() first.")
 
         try:
             # Detect input language
@@ -85,23 +330,23 @@ class Chatbot:
             else:
                 input_for_bot = user_input
 
-            # Generate response using BlenderBot
-            inputs = self.bb_tokenizer([input_for_bot], return_tensors="pt").to(self.device)
-            reply_ids = self.bb_model.generate(
-                **inputs,
-                max_length=max_length,
-                num_beams=num_beams,
-                no_repeat_ngram_size=2,  # Prevent repetitive phrases
-                early_stopping=True      # Stop early to save computation
+            # Generate response using BlenderBot, batched with concurrent requests
+            input_ids = self._build_bot_input_ids(input_for_bot, history, max_length)
+            response_en = self._request_queue.generate(
+                input_ids, max_length=max_length, num_beams=num_beams
             )
-            response_en = self.bb_tokenizer.decode(reply_ids[0], skip_special_tokens=True)
 
             # Translate response back to Persian if needed
             if user_lang == "fa":
                 response_final = self._cached_translate(response_en, "en_fa")
+                # Remember the reverse pair so this reply is free to reuse as context
+                self._cache_translation(("fa_en", _normalize(response_final)), response_en)
             else:
                 response_final = response_en
 
+            if english_out is not None:
+                english_out.update(user=input_for_bot, bot=response_en)
+
             logger.debug(f"Generated response: {response_final}")
             return response_final
 
@@ -109,7 +354,65 @@ class Chatbot:
             logger.error(f"Error during response generation: {str(e)}")
             raise RuntimeError(f"Failed to generate response: {str(e)}")
 
+    def stream_response(self, user_input, max_length=128, timeout=60.0, history=None, english_out=None):
+        """
+        Generate a response incrementally, yielding text chunks as they are decoded.
+
+        English replies are decoded greedily (streaming is not supported with
+        beam search) through the shared request queue, batched with concurrent
+        requests. Persian replies must be translated as a whole, so they are
+        produced by `generate_response` and yielded once.
+
+        Args:
+            user_input (str): Input text from the user (Persian or English).
+            max_length (int): Maximum length of the generated response.
+            timeout (float): Seconds to wait for each new chunk before giving up.
+            history (list): Previous turns, oldest first (see `generate_response`).
+            english_out (dict): If given, filled with the English text of this turn
+                under 'user' and 'bot' once the response is complete.
+
+        Yields:
+            str: Successive pieces of the response.
+
+        Raises:
+            ValueError: If input is empty or invalid.
+            RuntimeError: If models are not loaded or inference fails.
+        """
+        if not user_input or not isinstance(user_input, str):
+            logger.error("Invalid or empty input provided.")
+            raise ValueError("Input must be a non-empty string.")
+
+        if not self._is_initialized:
+            logger.error("generate called before models were loaded.")
+            raise RuntimeError("Models are not loaded. Call initialize_models() first.")
+
+        if detect_language(user_input) == "fa":
+            yield self.generate_response(
+                user_input, max_length=max_length, history=history, english_out=english_out
+            )
+            return
+
+        input_ids = self._build_bot_input_ids(user_input, history, max_length)
+        streamer = TextIteratorStreamer(self.bb_tokenizer, skip_special_tokens=True, timeout=timeout)
+        future = self._request_queue.stream(input_ids, streamer, max_length=max_length)
+
+        chunks = []
+        try:
+            for text in streamer:
+                if text:
+                    chunks.append(text)
+                    yield text
+            # Surface errors raised by the queue worker
+            future.result()
+        except Exception as e:
+            logger.error(f"Error during response streaming: {str(e)}")
+            raise RuntimeError(f"Failed to generate response: {str(e)}")
+
+        if english_out is not None:
+            english_out.update(user=user_input, bot="".join(chunks).strip())
+
     def clear_cache(self):
         """Clear the translation cache to free memory."""
-        self._cached_translate.cache_clear()
+        with self._trans_cache_lock:
+            self._trans_cache.clear()
         logger.info("Translation cache cleared.")
@@ -6,28 +6,249 @@ Efficiently loads and caches the conversation and translation models.
 Supports device management (CPU/GPU), error handling, and optional model optimization.
 """
 
+import importlib.util
+import os
+import platform
+import shutil
 import torch
 import logging
 from functools import lru_cache
 from transformers import (
+    AutoTokenizer,
+    BitsAndBytesConfig,
     BlenderbotSmallTokenizer,
     BlenderbotSmallForConditionalGeneration,
-    MT5ForConditionalGeneration,
-    MT5Tokenizer,
+    M2M100ForConditionalGeneration,
 )
 
+# Optional: Use ONNX Runtime (via optimum) for faster CPU inference
+try:
+    from optimum.onnxruntime import ORTModelForSeq2SeqLM, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    ONNXRUNTIME_AVAILABLE = True
+except ImportError:
+    ONNXRUNTIME_AVAILABLE = False
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Exported ONNX graphs are cached here so only the first start pays for export
+ONNX_CACHE_DIR = os.environ.get(
+    "CHATBOT_ONNX_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "ai1900-chatbot", "onnx")
+)
+
+class _BeamableCrossAttentionMixin:
+    """
+    Skip reordering of cross-attention states during beam search.
+
+    Every beam of a hypothesis attends to the same (replicated) encoder output,
+    so cross-attention keys/values are identical across beams and selecting
+    them with `beam_idx` is a no-op that still costs a full copy per layer and
+    step. Only the self-attention cache is reordered.
+    """
+
+    @staticmethod
+    def _reorder_cache(past_key_values, beam_idx):
+        # Cache objects (EncoderDecoderCache) keep self/cross caches separately
+        if hasattr(past_key_values, "self_attention_cache"):
+            past_key_values.self_attention_cache.reorder_cache(beam_idx)
+            return past_key_values
+
+        # Legacy tuples: (self_k, self_v, cross_k, cross_v) per layer
+        reordered_past = ()
+        for layer_past in past_key_values:
+            reordered_past += (
+                tuple(
+                    past_state.index_select(0, beam_idx.to(past_state.device))
+                    for past_state in layer_past[:2]
+                )
+                + tuple(layer_past[2:]),
+            )
+        return reordered_past
+
+class BeamableBlenderbotSmallForConditionalGeneration(
+    _BeamableCrossAttentionMixin, BlenderbotSmallForConditionalGeneration
+):
+    """BlenderBotSmall that does not reorder encoder states between beam steps."""
+
+class BeamableM2M100ForConditionalGeneration(
+    _BeamableCrossAttentionMixin, M2M100ForConditionalGeneration
+):
+    """M2M100 / NLLB that does not reorder encoder states between beam steps."""
+
+def _attention_candidates(device, use_fp16=False):
+    """Return attention backends to try, fastest first."""
+    candidates = ["sdpa", "eager"]
+    # FlashAttention kernels only run on GPU with half-precision weights
+    if device == "cuda" and use_fp16 and importlib.util.find_spec("flash_attn") is not None:
+        candidates.insert(0, "flash_attention_2")
+    return candidates
+
+def _quantization_kwargs(device, quantize):
+    """
+    Return `from_pretrained` kwargs for load-time (bitsandbytes) quantization.
+
+    Only used on CUDA; CPU models are quantized after loading instead.
+    """
+    if quantize != "int8" or device != "cuda":
+        return {}
+    if importlib.util.find_spec("bitsandbytes") is None:
+        logger.warning("bitsandbytes is not installed; loading models without int8 quantization.")
+        return {}
+    return {
+        "quantization_config": BitsAndBytesConfig(load_in_8bit=True),
+        "device_map": {"": device},
+    }
+
+def _from_pretrained(model_cls, model_name, device, use_fp16=False, **load_kwargs):
+    """
+    Load a model with the fastest attention backend it supports.
+
+    Falls back to eager attention for architectures or transformers versions
+    that do not support SDPA / FlashAttention.
+    """
+    torch_dtype = torch.float16 if use_fp16 and device == "cuda" else torch.float32
+    last_error = None
+    for attn_implementation in _attention_candidates(device, use_fp16):
+        try:
+            model = model_cls.from_pretrained(
+                model_name,
+                attn_implementation=attn_implementation,
+                torch_dtype=torch_dtype,
+                **load_kwargs,
+            )
+            logger.info(f"Loaded {model_name} with {attn_implementation} attention.")
+            return model
+        except (ImportError, TypeError, ValueError) as e:
+            logger.debug(f"{attn_implementation} attention unavailable for {model_name}: {str(e)}")
+            last_error = e
+    # Older transformers versions do not accept `attn_implementation` at all
+    logger.warning(f"Falling back to default attention for {model_name}: {str(last_error)}")
+    return model_cls.from_pretrained(model_name, torch_dtype=torch_dtype, **load_kwargs)
+
+def _prepare_model(model, device, quantize=None, quantized_on_load=False):
+    """
+    Move a freshly loaded model to `device`, set eval mode and apply CPU quantization.
+
+    Models quantized by bitsandbytes are already placed on the GPU and cannot be moved.
+    """
+    if not quantized_on_load:
+        model = model.to(device)
+    model.eval()
+
+    if quantize == "int8" and device == "cpu":
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        logger.info(f"Applied dynamic int8 quantization to {model.__class__.__name__}.")
+        # Dynamically quantized Linear layers cannot be captured by torch.compile
+        return model
+
+    # `generate` only auto-compiles on CUDA and never for bitsandbytes layers;
+    # without compilation a static cache only adds padding
+    if quantized_on_load or device != "cuda":
+        return model
+
+    return _enable_static_cache(model)
+
+def _enable_static_cache(model):
+    """
+    Make `generate` use a static KV cache so the decode step is auto-compiled.
+
+    The cache is only switched on for architectures whose forward pass can be
+    compiled as a full graph (BlenderBotSmall, but not M2M100/NLLB); other
+    models keep the default dynamic cache.
+    """
+    if getattr(model, "_can_compile_fullgraph", False):
+        model.generation_config.cache_implementation = "static"
+        logger.info(f"Enabled static KV cache for {model.__class__.__name__}.")
+    return model
+
+def _load_torch_model(model_cls, model_name, device, use_fp16=False, quantize=None):
+    """Load a PyTorch model with the attention, precision and quantization optimizations above."""
+    quant_kwargs = _quantization_kwargs(device, quantize)
+    use_fp16 = use_fp16 and not quant_kwargs
+    model = _from_pretrained(model_cls, model_name, device, use_fp16=use_fp16, **quant_kwargs)
+    if use_fp16 and device == "cuda":
+        logger.info(f"Applied FP16 precision to {model_name}.")
+
+    # Move model to specified device and set evaluation mode
+    return _prepare_model(model, device, quantize, quantized_on_load=bool(quant_kwargs))
+
+def _onnx_enabled(device, use_onnx):
+    """ONNX Runtime is only used for CPU inference and when optimum is installed."""
+    if not use_onnx or device != "cpu":
+        return False
+    if not ONNXRUNTIME_AVAILABLE:
+        logger.info("optimum[onnxruntime] is not installed; using the PyTorch backend.")
+        return False
+    return True
+
+def _onnx_quantization_config():
+    """Dynamic int8 quantization config matching the host CPU."""
+    if platform.machine().lower() in ("arm64", "aarch64"):
+        return AutoQuantizationConfig.arm64(is_static=False, per_channel=False)
+    return AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+
+def _load_onnx_model(model_name, quantize=None):
+    """
+    Load a seq2seq model on ONNX Runtime, exporting and quantizing it on first use.
+
+    The exported graphs (and their int8 variants) are saved under
+    `ONNX_CACHE_DIR`, so later starts load them directly.
+    """
+    provider = "CPUExecutionProvider"
+    export_dir = os.path.join(ONNX_CACHE_DIR, model_name.replace("/", "--"))
+    if not os.path.isfile(os.path.join(export_dir, "config.json")):
+        logger.info(f"Exporting {model_name} to ONNX (one-time)...")
+        model = ORTModelForSeq2SeqLM.from_pretrained(model_name, export=True, provider=provider)
+        model.save_pretrained(export_dir)
+
+    if quantize != "int8":
+        logger.info(f"Loaded {model_name} on ONNX Runtime.")
+        return ORTModelForSeq2SeqLM.from_pretrained(export_dir, provider=provider)
+
+    quantized_dir = os.path.join(export_dir, "int8")
+    onnx_files = sorted(f for f in os.listdir(export_dir) if f.endswith(".onnx"))
+    if not os.path.isfile(os.path.join(quantized_dir, "config.json")):
+        logger.info(f"Quantizing ONNX graphs of {model_name} to int8 (one-time)...")
+        quantization_config = _onnx_quantization_config()
+        for file_name in onnx_files:
+            quantizer = ORTQuantizer.from_pretrained(export_dir, file_name=file_name)
+            quantizer.quantize(save_dir=quantized_dir, quantization_config=quantization_config)
+        for file_name in ("config.json", "generation_config.json"):
+            if os.path.isfile(os.path.join(export_dir, file_name)):
+                shutil.copy(os.path.join(export_dir, file_name), quantized_dir)
+
+    # Point each graph slot at its quantized file (`<name>_quantized.onnx`)
+    file_kwargs = {}
+    for file_name in onnx_files:
+        stem = file_name[: -len(".onnx")]
+        if stem.startswith("encoder"):
+            file_kwargs["encoder_file_name"] = f"{stem}_quantized.onnx"
+        elif stem.startswith("decoder_with_past"):
+            file_kwargs["decoder_with_past_file_name"] = f"{stem}_quantized.onnx"
+        elif stem.startswith("decoder"):
+            file_kwargs["decoder_file_name"] = f"{stem}_quantized.onnx"
+    logger.info(f"Loaded {model_name} on ONNX Runtime with int8 quantization.")
+    return ORTModelForSeq2SeqLM.from_pretrained(quantized_dir, provider=provider, **file_kwargs)
+
 @lru_cache(maxsize=1)
-def load_blenderbot_model(device="cuda" if torch.cuda.is_available() else "cpu", use_fp16=False):
+def load_blenderbot_model(
+    device="cuda" if torch.cuda.is_available() else "cpu",
+    use_fp16=False,
+    quantize="int8",
+    use_onnx=True,
+):
     """
     Load and cache BlenderBot small model for dialogue.
 
     Args:
         device (str): Device to load the model on ('cuda' or 'cpu').
         use_fp16 (bool): Use mixed precision (float16) for GPU to save memory.
+            Ignored when quantization is active.
+        quantize (str | None): 'int8' for bitsandbytes (GPU), ONNX Runtime or
+            dynamic PyTorch (CPU) int8 quantization, None to keep full-precision weights.
+        use_onnx (bool): Run on ONNX Runtime when on CPU and optimum is installed.
 
     Returns:
         tuple: (tokenizer, model) for BlenderBotSmall.
@@ -39,18 +260,12 @@ def load_blenderbot_model(device="cuda" if torch.cuda.is_available() else "cpu",
         logger.info(f"Loading BlenderBotSmall model on {device}...")
         model_name = "facebook/blenderbot_small-90M"
         tokenizer = BlenderbotSmallTokenizer.from_pretrained(model_name)
-        model = BlenderbotSmallForConditionalGeneration.from_pretrained(model_name)
-
-        # Move model to specified device
-        model = model.to(device)
-        
-        # Use mixed precision if enabled and on GPU
-        if use_fp16 and device == "cuda":
-            model = model.half()
-            logger.info("Applied FP16 precision to BlenderBot model.")
-
-        # Set model to evaluation mode
-        model.eval()
+        if _onnx_enabled(device, use_onnx):
+            model = _load_onnx_model(model_name, quantize)
+        else:
+            model = _load_torch_model(
+                BeamableBlenderbotSmallForConditionalGeneration, model_name, device, use_fp16, quantize
+            )
         logger.info("BlenderBotSmall model loaded successfully.")
         return tokenizer, model
 
@@ -59,49 +274,47 @@ def load_blenderbot_model(device="cuda" if torch.cuda.is_available() else "cpu",
         raise RuntimeError(f"BlenderBot model loading failed: {str(e)}")
 
 @lru_cache(maxsize=1)
-def load_translation_models(device="cuda" if torch.cuda.is_available() else "cpu", use_fp16=False):
+def load_translation_models(
+    device="cuda" if torch.cuda.is_available() else "cpu",
+    use_fp16=False,
+    quantize="int8",
+    use_onnx=True,
+):
     """
-    Load and cache Persian <-> English translation models.
+    Load and cache the Persian <-> English translation model.
+
+    A single multilingual NLLB model covers both directions; the direction is
+    chosen per call through the tokenizer's source language and the forced
+    target-language BOS token.
 
     Args:
-        device (str): Device to load the models on ('cuda' or 'cpu').
+        device (str): Device to load the model on ('cuda' or 'cpu').
         use_fp16 (bool): Use mixed precision (float16) for GPU to save memory.
+            Ignored when quantization is active.
+        quantize (str | None): 'int8' for bitsandbytes (GPU), ONNX Runtime or
+            dynamic PyTorch (CPU) int8 quantization, None to keep full-precision weights.
+        use_onnx (bool): Run on ONNX Runtime when on CPU and optimum is installed.
 
     Returns:
-        dict: Dictionary with keys 'fa_en' and 'en_fa', each containing (tokenizer, model).
+        dict: Dictionary with the single key 'nllb' containing (tokenizer, model).
 
     Raises:
         RuntimeError: If model loading fails.
     """
     try:
-        logger.info(f"Loading translation models on {device}...")
-        fa_en_model_name = "persiannlp/mt5-small-parsinlu-opus-translation_fa_en"
-        en_fa_model_name = "persiannlp/mt5-small-parsinlu-translation_en_fa"
-
-        # Load Persian to English model
-        fa_en_tokenizer = MT5Tokenizer.from_pretrained(fa_en_model_name)
-        fa_en_model = MT5ForConditionalGeneration.from_pretrained(fa_en_model_name)
-        fa_en_model = fa_en_model.to(device)
-        if use_fp16 and device == "cuda":
-            fa_en_model = fa_en_model.half()
-
-        # Load English to Persian model
-        en_fa_tokenizer = MT5Tokenizer.from_pretrained(en_fa_model_name)
-        en_fa_model = MT5ForConditionalGeneration.from_pretrained(en_fa_model_name)
-        en_fa_model = en_fa_model.to(device)
-        if use_fp16 and device == "cuda":
-            en_fa_model = en_fa_model.half()
-
-        # Set models to evaluation mode
-        fa_en_model.eval()
-        en_fa_model.eval()
-
-        logger.info("Translation models loaded successfully.")
-        return {
-            "fa_en": (fa_en_tokenizer, fa_en_model),
-            "en_fa": (en_fa_tokenizer, en_fa_model),
-        }
+        logger.info(f"Loading translation model on {device}...")
+        model_name = "facebook/nllb-200-distilled-600M"
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        if _onnx_enabled(device, use_onnx):
+            model = _load_onnx_model(model_name, quantize)
+        else:
+            model = _load_torch_model(
+                BeamableM2M100ForConditionalGeneration, model_name, device, use_fp16, quantize
+            )
+
+        logger.info("Translation model loaded successfully.")
+        return {"nllb": (tokenizer, model)}
 
     except Exception as e:
-        logger.error(f"Failed to load translation models: {str(e)}")
-        raise RuntimeError(f"Translation models loading failed: {str(e)}")
+        logger.error(f"Failed to load translation model: {str(e)}")
+        raise RuntimeError(f"Translation model loading failed: {str(e)}")